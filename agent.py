@@ -1,56 +1,176 @@
 # agent.py
 import os
-import json
-from openai import OpenAI
+import re
+import sys
+import asyncio
+import argparse
+import logging
+import threading
+import httpx
+import orjson
+from functools import lru_cache
+from typing import Callable, Optional
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
-from prompts import SYSTEM_PROMPT
+from prompts import SYSTEM_PROMPT_CORE, PROMPT_EXAMPLES, ORDER_STATUS_TEMPLATES, TRACKING_TEMPLATE
 from functions import (
-    check_order_status,
-    check_tracking,
-    initiate_refund,
-    check_return_status,
     process_return_receipt,
-    FUNCTION_DEFINITIONS
+    drain_background_writes,
+    FUNCTION_DEFINITIONS,
+    FUNCTION_MAP
 )
-from database import db
+from database import get_db
 from state import AgentState
+from cache import response_cache
+from batch import process_returns_file, submit_summary_batch, fetch_batch_summaries, summarize_realtime
+from ratelimit import rate_limiter, count_message_tokens, probe_limits, with_retries
+from log_config import configure_logging, ui_logger
 
 # Load environment variables
 load_dotenv()
 
+# Structured events (function calls, cache hits, stuck detection) for log shipping
+logger = logging.getLogger("agent")
+
+# Bound once to skip attribute lookups in the logging hot path
+_dumps = orjson.dumps
+
+
+def _pretty(obj) -> str:
+    """Pretty-print JSON for admin/debug output"""
+    return _dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+
+class _LazyPretty:
+    """Defers pretty-printing until a log handler actually formats the message"""
+    __slots__ = ("obj",)
+    
+    def __init__(self, obj):
+        self.obj = obj
+    
+    def __str__(self) -> str:
+        return _pretty(self.obj)
+
+
+# Order IDs mentioned in a user message (e.g. "12345" or "RET-12345")
+ORDER_ID_PATTERN = re.compile(r"\b(?:RET-|REF-)?(\d{5,})\b")
+
+# History compaction: summarize older turns once committed history exceeds
+# MAX_HISTORY_TOKENS, keeping the most recent turns verbatim. The older slice
+# must hold at least MIN_COMPACT_TOKENS, so large recent turns alone don't
+# trigger a new summary (and a prefix rewrite) every turn
+MAX_HISTORY_TOKENS = 8000
+MIN_COMPACT_TOKENS = 2000
+KEEP_RECENT_TURNS = 6
+SUMMARY_INSTRUCTIONS = (
+    "Summarize this customer support conversation for the agent's future reference. "
+    "Keep order IDs, return/refund IDs, amounts, statuses, actions taken and open issues."
+)
+
+# Tools that write to the database; these hold the db lock, lookups run concurrently
+MUTATING_FUNCTIONS = {"initiate_refund"}
+
+# Keywords that pick a session's few-shot example, highest priority first
+INTENT_KEYWORDS = (
+    ("return_status", ("return status", "status of my return", "my return", "ret-")),
+    ("processing_refund", ("cancel",)),
+    ("shipped_refund", ("refund", "return", "damaged", "broken", "wrong item"))
+)
+
+# All intent keywords in one alternation (one named group per intent), scanned in a single pass
+INTENT_PATTERN = re.compile(
+    "|".join(f"(?P<{intent}>{'|'.join(map(re.escape, keywords))})" for intent, keywords in INTENT_KEYWORDS),
+    re.IGNORECASE
+)
+_INTENT_PRIORITY = {intent: rank for rank, (intent, _) in enumerate(INTENT_KEYWORDS)}
+
+
+def _classify_intent(message: str) -> Optional[str]:
+    """Coarse intent of a message by keyword match (None if nothing matches)"""
+    matched = {match.lastgroup for match in INTENT_PATTERN.finditer(message)}
+    return min(matched, key=_INTENT_PRIORITY.__getitem__, default=None)
+
+
+@lru_cache(maxsize=None)
+def _system_prompt_for(intent: Optional[str]) -> str:
+    """Core system prompt plus the example for an intent (composed once per intent)"""
+    if intent is None:
+        return SYSTEM_PROMPT_CORE
+    return f"{SYSTEM_PROMPT_CORE}\nEXAMPLE INTERACTION:\n\n{PROMPT_EXAMPLES[intent]}\n"
+
+
+# Problem category tracked for each function
+PROBLEM_CATEGORIES = {
+    "initiate_refund": "refund_issue",
+    "check_return_status": "refund_issue",
+    "check_tracking": "tracking_issue",
+    "check_order_status": "order_inquiry",
+    "check_order_status_batch": "order_inquiry"
+}
+
+RETURN_ID_PREFIX = "RET-"
+
+# Read-only lookups whose answers are safe to serve from the semantic cache
+CACHEABLE_FUNCTIONS = {"check_order_status", "check_tracking", "check_return_status"}
+
+# Message intents that are plain inquiries (refund/cancel requests are never cached)
+CACHEABLE_INTENTS = {None, "return_status"}
+
+# Deterministic lookups that can be answered from a template without a second LLM call
+TEMPLATABLE_FUNCTIONS = {"check_order_status", "check_tracking"}
+
+# Tool schemas shared by every agent, built once at import
+TOOLS = tuple({"type": "function", "function": definition} for definition in FUNCTION_DEFINITIONS)
+
+
+def _build_client() -> Optional[AsyncOpenAI]:
+    """Create the shared OpenAI client (None if no API key is configured)"""
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return None
+    return AsyncOpenAI(
+        api_key=api_key,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+    )
+
+
+# Shared client so every agent reuses one connection pool (and its TLS sessions)
+_CLIENT = _build_client()
+
 
 class CustomerSupportAgent:
-    def __init__(self):
-        # Initialize OpenAI client
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
+    def __init__(self, client: Optional[AsyncOpenAI] = None):
+        # Use the injected OpenAI client, or the shared module-level one
+        self.client = client or _CLIENT
+        if self.client is None:
             raise ValueError("OPENAI_API_KEY not found in .env file!")
         
-        self.client = OpenAI(api_key=api_key)
-        self.conversation_history = []
+        # Prompt buffer: the prefix (system prompt + committed turns) is append-only
+        # so it stays byte-stable for OpenAI prompt caching; the suffix holds the
+        # in-flight turn and is only committed once the final answer arrives
+        # The system prompt is chosen on the session's first message, then never changes
+        self._system_msg = None
+        self._tools = TOOLS
+        self._prefix = []
+        self._suffix = []
         self.model = "gpt-4o-mini"  # Change to "gpt-4o" for better quality
+        self.embedding_model = "text-embedding-3-small"
+        self.summary_model = "gpt-4o-mini"
+        self._rate_limits_probed = False
         
         # Initialize state tracking
         self.state = AgentState()
         
-        # Map function names to actual functions
-        self.available_functions = {
-            "check_order_status": check_order_status,
-            "check_tracking": check_tracking,
-            "initiate_refund": initiate_refund,
-            "check_return_status": check_return_status
-        }
+        # Drop cached answers whenever the underlying order data changes
+        # (registered here rather than at import so the database stays lazy)
+        get_db().add_change_listener(response_cache.invalidate_order)
     
     def _determine_problem_category(self, function_name: str) -> str:
         """Determine problem category from function name"""
-        if function_name in ["initiate_refund", "check_return_status"]:
-            return "refund_issue"
-        elif function_name == "check_tracking":
-            return "tracking_issue"
-        elif function_name == "check_order_status":
-            return "order_inquiry"
-        else:
-            return "general"
+        return PROBLEM_CATEGORIES.get(function_name, "general")
     
     def _extract_order_id(self, function_args: dict) -> str:
         """Extract order ID from function arguments"""
@@ -60,23 +180,282 @@ class CustomerSupportAgent:
         
         # Extract from return_id (format: RET-12345)
         if "return_id" in function_args:
-            return function_args["return_id"].replace("RET-", "")
+            return function_args["return_id"].removeprefix(RETURN_ID_PREFIX)
+        
+        # Batch lookups are tracked under all their orders
+        if function_args.get("order_ids"):
+            return ",".join(function_args["order_ids"])
         
         return "unknown"
     
-    def chat(self, user_message: str) -> str:
+    def _extract_cache_scope(self, user_message: str) -> Optional[str]:
+        """Find the order a message is about, used to scope semantic cache entries"""
+        match = ORDER_ID_PATTERN.search(user_message)
+        return match.group(1) if match else None
+    
+    async def _embed(self, text: str) -> Optional[list]:
+        """Embed text for semantic cache lookups (None if the call fails)"""
+        await self._ensure_rate_limits()
+        tokens = count_message_tokens(self.embedding_model, [{"role": "user", "content": text}])
+        
+        async def call():
+            await rate_limiter.acquire(tokens)
+            return await self.client.embeddings.create(model=self.embedding_model, input=text)
+        
+        try:
+            response = await with_retries(call)
+            return response.data[0].embedding
+        except Exception as e:
+            ui_logger.warning("⚠️  Embedding failed, skipping cache: %s", e)
+            return None
+    
+    async def _ensure_rate_limits(self):
+        """Configure the shared rate limiter from env vars, or probe the account limits once"""
+        if rate_limiter.configured or self._rate_limits_probed:
+            return
+        self._rate_limits_probed = True
+        
+        max_rpm = os.getenv("OPENAI_MAX_REQUESTS_PER_MINUTE")
+        max_tpm = os.getenv("OPENAI_MAX_TOKENS_PER_MINUTE")
+        if max_rpm and max_tpm:
+            rate_limiter.configure(float(max_rpm), float(max_tpm))
+            return
+        
+        try:
+            max_rpm, max_tpm = await probe_limits(self.client, self.model)
+        except Exception as e:
+            ui_logger.warning("⚠️  Could not probe rate limits, running unthrottled: %s", e)
+            return
+        if max_rpm and max_tpm:
+            rate_limiter.configure(max_rpm, max_tpm)
+    
+    async def _create_completion(self, **kwargs):
+        """Chat completion call that respects the rate limiter and retries transient errors"""
+        await self._ensure_rate_limits()
+        model = kwargs.pop("model", self.model)
+        tokens = count_message_tokens(model, kwargs["messages"])
+        
+        async def call():
+            await rate_limiter.acquire(tokens)
+            return await self.client.chat.completions.create(model=model, **kwargs)
+        
+        return await with_retries(call)
+    
+    @property
+    def conversation_history(self) -> list:
+        """Committed conversation turns (without the system prompt)"""
+        return self._prefix[1:]
+    
+    def _messages(self) -> list:
+        """Build the request messages: cached prefix followed by the in-flight turn"""
+        return self._prefix + self._suffix
+    
+    def _commit_turn(self):
+        """Atomically move the finished turn from the suffix into the prefix"""
+        self._prefix.extend(self._suffix)
+        self._suffix = []
+    
+    async def _compact_history(self):
         """
-        Main chat method - handles conversation with function calling
+        Replace older committed turns with a single summary message once the
+        history grows past MAX_HISTORY_TOKENS. The prefix only changes here,
+        so it stays byte-stable (and cacheable) between compactions.
         """
-        print(f"\n{'='*60}")
-        print(f"USER: {user_message}")
-        print(f"{'='*60}")
+        history = self._prefix[1:]
+        if count_message_tokens(self.model, history) <= MAX_HISTORY_TOKENS:
+            return
+        
+        # Each turn starts with a user message; keep the last few turns verbatim
+        turn_starts = [i for i, m in enumerate(history) if m["role"] == "user"]
+        if len(turn_starts) <= KEEP_RECENT_TURNS:
+            return
+        boundary = turn_starts[-KEEP_RECENT_TURNS]
+        older, recent = history[:boundary], history[boundary:]
+        if count_message_tokens(self.model, older) < MIN_COMPACT_TOKENS:
+            return
+        
+        transcript = []
+        for m in older:
+            if m.get("tool_calls"):
+                for call in m["tool_calls"]:
+                    transcript.append(f"assistant called {call['function']['name']}({call['function']['arguments']})")
+            else:
+                transcript.append(f"{m['role']}: {m['content']}")
+        
+        try:
+            response = await self._create_completion(
+                model=self.summary_model,
+                messages=[
+                    {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+                    {"role": "user", "content": "\n".join(transcript)}
+                ],
+                temperature=0
+            )
+            summary = response.choices[0].message.content
+        except Exception as e:
+            ui_logger.warning("⚠️  History compaction failed, keeping full history: %s", e)
+            return
+        
+        self._prefix = [
+            self._system_msg,
+            {"role": "system", "content": f"Summary so far: {summary}"},
+            *recent
+        ]
+        ui_logger.info("🗜️  Compacted %d older messages into a summary", len(older))
+    
+    async def _run_tool_call(self, tool_call) -> dict:
+        """Execute one tool call from the model, tracking attempts per problem"""
+        function_name = tool_call.function.name
+        function_args = orjson.loads(tool_call.function.arguments)
         
-        # Add user message to history
-        self.conversation_history.append({
+        ui_logger.info("\n🔧 CALLING FUNCTION: %s\n📋 ARGUMENTS: %s", function_name, _LazyPretty(function_args))
+        
+        # Track attempt for this problem
+        problem_category = self._determine_problem_category(function_name)
+        order_id = self._extract_order_id(function_args)
+        self.state.record_attempt(problem_category, order_id)
+        logger.info("function_call", extra={"fields": {
+            "function": function_name,
+            "arguments": function_args,
+            "problem_category": problem_category,
+            "order_id": order_id
+        }})
+        
+        # Check if stuck on this problem
+        attempts = self.state.get_attempts(problem_category, order_id)
+        if self.state.is_stuck(problem_category, order_id):
+            logger.warning("stuck_detected", extra={"fields": {
+                "attempts": attempts,
+                "problem_category": problem_category,
+                "order_id": order_id
+            }})
+            ui_logger.info("⚠️  STUCK DETECTED: %d attempts on %s for order %s\n"
+                           "🔥 Consider escalating or trying different approach",
+                           attempts, problem_category, order_id)
+        
+        # Get the function from our mapping
+        function_to_call = FUNCTION_MAP.get(function_name)
+        resolved = False
+        
+        if not function_to_call:
+            ui_logger.error("❌ Unknown function: %s", function_name)
+            function_response = {"error": f"Unknown function: {function_name}", "success": False}
+        else:
+            # Call the function
+            try:
+                # Serialize database mutations across concurrent sessions
+                if function_name in MUTATING_FUNCTIONS:
+                    async with get_db().lock:
+                        function_response = await function_to_call(**function_args)
+                else:
+                    function_response = await function_to_call(**function_args)
+                logger.info("function_result", extra={"fields": {
+                    "function": function_name,
+                    "success": function_response.get("success", True)
+                }})
+                resolved = function_response.get("success", True)
+                
+            except Exception as e:
+                ui_logger.error("❌ Function error: %s", e)
+                function_response = {"error": f"Failed to execute {function_name}"}
+        
+        # Serialize once (compact) for both the log line and the history
+        function_response_json = _dumps(function_response).decode()
+        ui_logger.info("✅ FUNCTION RESULT: %s", function_response_json)
+        
+        # If successful, reset attempts for this problem
+        if resolved:
+            self.state.reset_problem(problem_category, order_id)
+            ui_logger.info("✨ Problem resolved! Reset attempts for %s:%s", problem_category, order_id)
+        
+        return {
+            "tool_call_id": tool_call.id,
+            "function_name": function_name,
+            "problem_category": problem_category,
+            "order_id": order_id,
+            "response": function_response,
+            "response_json": function_response_json
+        }
+    
+    async def _stream_final_response(self, temperature: float, top_p: float,
+                                     on_token: Optional[Callable[[str], None]], chunks: list) -> str:
+        """Get the final answer after tool calls, streaming chunks into `chunks` (and on_token)"""
+        # Same tool list keeps the prompt prefix cacheable; "none" forces a text answer
+        response = await self._create_completion(
+            messages=self._messages(),
+            tools=self._tools,
+            tool_choice="none",
+            temperature=temperature,
+            top_p=top_p,
+            stream=True
+        )
+        
+        async for chunk in response:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                chunks.append(delta)
+                if on_token:
+                    on_token(delta)
+        
+        return "".join(chunks)
+    
+    def _render_template(self, result: dict) -> Optional[str]:
+        """Render a canned reply for a simple lookup result (None if it needs the LLM)"""
+        response = result["response"]
+        if result["function_name"] not in TEMPLATABLE_FUNCTIONS or not response.get("success", True):
+            return None
+        
+        try:
+            if result["function_name"] == "check_tracking":
+                return TRACKING_TEMPLATE.format(**response)
+            
+            # Orders with returns/refunds in flight need a real explanation
+            template = ORDER_STATUS_TEMPLATES.get(response["status"])
+            if not template or "return_info" in response or "refund_info" in response:
+                return None
+            return template.format(**{**response, "items": ", ".join(response["items"])})
+        except KeyError:
+            return None
+    
+    async def chat(self, user_message: str, on_token: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Main chat method - handles conversation with function calling.
+        If on_token is given, the final response after a function call is
+        streamed to it chunk by chunk as it is generated.
+        """
+        ui_logger.info("\n%s\nUSER: %s\n%s", "=" * 60, user_message, "=" * 60)
+        
+        # Refund/cancel/return requests need the LLM even when only a lookup ran
+        intent = _classify_intent(user_message)
+        
+        # Start the session with the example matching the first message's intent
+        if self._system_msg is None:
+            self._system_msg = {"role": "system", "content": _system_prompt_for(intent)}
+            self._prefix = [self._system_msg]
+        
+        # Keep the committed history within the token budget
+        await self._compact_history()
+        
+        # Start a new in-flight turn with the user message
+        self._suffix = [{
             "role": "user",
             "content": user_message
-        })
+        }]
+        
+        # Serve repeated questions about the same order from the semantic cache
+        cache_scope = self._extract_cache_scope(user_message) if intent in CACHEABLE_INTENTS else None
+        query_embedding = await self._embed(user_message) if cache_scope else None
+        if query_embedding:
+            cached_message = response_cache.get(cache_scope, query_embedding)
+            if cached_message:
+                logger.info("cache_hit", extra={"fields": {"order_id": cache_scope}})
+                ui_logger.info("⚡ CACHE HIT for order %s", cache_scope)
+                self._suffix.append({
+                    "role": "assistant",
+                    "content": cached_message
+                })
+                self._commit_turn()
+                return cached_message
         
         # Determine temperature based on current problem state
         # We'll check after function call to see if we should adjust
@@ -85,108 +464,87 @@ class CustomerSupportAgent:
         
         # Call OpenAI API
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": SYSTEM_PROMPT},
-                    *self.conversation_history
-                ],
-                functions=FUNCTION_DEFINITIONS,
-                function_call="auto",
+            response = await self._create_completion(
+                messages=self._messages(),
+                tools=self._tools,
+                tool_choice="auto",
                 temperature=temperature,
                 top_p=top_p
             )
         except Exception as e:
-            error_msg = f"Error calling OpenAI API: {str(e)}"
-            print(f"❌ {error_msg}")
+            ui_logger.error("❌ Error calling OpenAI API: %s", e)
+            self._suffix = []
             return "I'm having trouble connecting right now. Please try again in a moment."
         
         message = response.choices[0].message
         
-        # Check if the model wants to call a function
-        if message.function_call:
-            function_name = message.function_call.name
-            function_args = json.loads(message.function_call.arguments)
-            
-            print(f"\n🔧 CALLING FUNCTION: {function_name}")
-            print(f"📋 ARGUMENTS: {json.dumps(function_args, indent=2)}")
-            
-            # Track attempt for this problem
-            problem_category = self._determine_problem_category(function_name)
-            order_id = self._extract_order_id(function_args)
-            self.state.record_attempt(problem_category, order_id)
-            
-            # Check if stuck on this problem
-            attempts = self.state.get_attempts(problem_category, order_id)
-            if self.state.is_stuck(problem_category, order_id):
-                print(f"⚠️  STUCK DETECTED: {attempts} attempts on {problem_category} for order {order_id}")
-                print(f"🔥 Consider escalating or trying different approach")
-            
-            # Get the function from our mapping
-            function_to_call = self.available_functions.get(function_name)
+        # Check if the model wants to call one or more tools
+        if message.tool_calls:
+            # Run every requested tool call in this single round trip
+            results = await asyncio.gather(*[self._run_tool_call(call) for call in message.tool_calls])
             
-            if not function_to_call:
-                print(f"❌ Unknown function: {function_name}")
-                return "I encountered an error. Let me try a different approach."
-            
-            # Call the function
-            try:
-                function_response = function_to_call(**function_args)
-                print(f"✅ FUNCTION RESULT: {json.dumps(function_response, indent=2)}")
-                
-                # If successful, reset attempts for this problem
-                if function_response.get("success", True):
-                    self.state.reset_problem(problem_category, order_id)
-                    print(f"✨ Problem resolved! Reset attempts for {problem_category}:{order_id}")
-                
-            except Exception as e:
-                print(f"❌ Function error: {str(e)}")
-                function_response = {"error": f"Failed to execute {function_name}"}
-            
-            # Add function call and result to conversation history
-            self.conversation_history.append({
+            # Add the tool calls and their results to the in-flight turn
+            self._suffix.append({
                 "role": "assistant",
-                "content": None,
-                "function_call": {
-                    "name": function_name,
-                    "arguments": message.function_call.arguments
-                }
+                "content": message.content,
+                "tool_calls": [
+                    {
+                        "id": call.id,
+                        "type": "function",
+                        "function": {
+                            "name": call.function.name,
+                            "arguments": call.function.arguments
+                        }
+                    }
+                    for call in message.tool_calls
+                ]
             })
             
-            self.conversation_history.append({
-                "role": "function",
-                "name": function_name,
-                "content": json.dumps(function_response)
-            })
+            for result in results:
+                self._suffix.append({
+                    "role": "tool",
+                    "tool_call_id": result["tool_call_id"],
+                    "content": result["response_json"]
+                })
             
-            # Adjust temperature if stuck
-            if self.state.is_stuck(problem_category, order_id):
+            # Adjust temperature if stuck on any of these problems
+            stuck = any(self.state.is_stuck(r["problem_category"], r["order_id"]) for r in results)
+            if stuck:
                 temperature = 1.0
                 top_p = 0.85
-                print(f"🔥 Increased temperature to {temperature} for next response")
+                ui_logger.info("🔥 Increased temperature to %s for next response", temperature)
             
-            # Call the API again to get the final response
+            # Pure status/tracking inquiries get a canned reply instead of a second
+            # API call (unless we're stuck, where a fresh LLM answer is the point)
+            templated = None if stuck or intent else [self._render_template(r) for r in results]
+            chunks = []
             try:
-                second_response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=[
-                        {"role": "system", "content": SYSTEM_PROMPT},
-                        *self.conversation_history
-                    ],
-                    temperature=temperature,
-                    top_p=top_p
-                )
+                if templated and all(templated):
+                    final_message = " ".join(templated)
+                    ui_logger.info("📝 Answered from template (skipped second API call)")
+                else:
+                    final_message = await self._stream_final_response(temperature, top_p, on_token, chunks)
                 
-                final_message = second_response.choices[0].message.content
+                # Cache answers to read-only lookups for similar future questions, filed
+                # under the order the tools actually looked up so invalidation finds them
+                looked_up = {r["order_id"] for r in results if r["order_id"] != "unknown"}
+                if query_embedding and len(looked_up) <= 1 and all(
+                    r["function_name"] in CACHEABLE_FUNCTIONS and r["response"].get("success") for r in results
+                ):
+                    function_names = ",".join(r["function_name"] for r in results)
+                    scope = looked_up.pop() if looked_up else cache_scope
+                    response_cache.set(scope, query_embedding, final_message, function_names)
             except Exception as e:
-                print(f"❌ Error getting final response: {str(e)}")
-                final_message = "I found the information but had trouble formulating a response. Please try asking again."
+                ui_logger.error("❌ Error getting final response: %s", e)
+                # Keep whatever was already streamed to the user
+                final_message = "".join(chunks) or "I found the information but had trouble formulating a response. Please try asking again."
             
-            # Add assistant's final response to history
-            self.conversation_history.append({
+            # Add assistant's final response and commit the whole turn
+            self._suffix.append({
                 "role": "assistant",
                 "content": final_message
             })
+            self._commit_turn()
             
             return final_message
             
@@ -194,125 +552,267 @@ class CustomerSupportAgent:
             # No function call - just a regular response
             assistant_message = message.content
             
-            self.conversation_history.append({
+            self._suffix.append({
                 "role": "assistant",
                 "content": assistant_message
             })
+            self._commit_turn()
             
             return assistant_message
     
     def reset(self):
         """Clear conversation history and state"""
-        self.conversation_history = []
+        self._system_msg = None
+        self._prefix = []
+        self._suffix = []
         self.state.reset_all()
-        print("\n🔄 Conversation and state reset!\n")
+        ui_logger.info("\n🔄 Conversation and state reset!\n")
 
 
-def handle_admin_command(command: str):
-    """Handle admin commands for simulation"""
-    parts = command.split()
-    
-    if len(parts) < 2:
-        print("❌ Invalid admin command")
-        print("\nAvailable commands:")
-        print("  /admin receive_return <return_id> <condition>")
-        print("  /admin show_orders")
-        print("  /admin show_returns")
-        print("  /admin show_refunds")
-        print("  /admin reset_database")
+ADMIN_HELP = """
+Available commands:
+  /admin receive_return <return_id> <condition>
+  /admin show_orders [status]
+  /admin show_returns
+  /admin show_refunds
+  /admin batch_process <file> [batch|realtime]
+  /admin batch_status <batch_id>
+  /admin reset_database"""
+
+
+async def _cmd_receive_return(parts: list, agent: Optional[CustomerSupportAgent]):
+    """Mark a return as received by the warehouse"""
+    if len(parts) < 3:
+        print("❌ Usage: /admin receive_return <return_id> <condition>")
+        print("   Conditions: good, damaged, damaged_beyond_acceptable")
         return
     
-    action = parts[1]
+    return_id = parts[2]
+    condition = parts[3] if len(parts) > 3 else "good"
     
-    if action == "receive_return":
-        if len(parts) < 3:
-            print("❌ Usage: /admin receive_return <return_id> <condition>")
-            print("   Conditions: good, damaged, damaged_beyond_acceptable")
-            return
-        
-        return_id = parts[2]
-        condition = parts[3] if len(parts) > 3 else "good"
-        
-        result = process_return_receipt(return_id, condition)
-        
-        if result["success"]:
-            print(f"\n✅ {result['message']}")
-            print(f"   Return ID: {result['return_id']}")
-            print(f"   Condition: {result['condition']}")
-            print(f"   Status: {result['status']}")
-            if result.get('refund_id'):
-                print(f"   Refund ID: {result['refund_id']}")
-        else:
-            print(f"\n❌ {result.get('error', 'Failed to process return')}")
+    async with get_db().lock:
+        result = await process_return_receipt(return_id, condition)
     
-    elif action == "show_orders":
+    if result["success"]:
+        print(f"\n✅ {result['message']}")
+        print(f"   Return ID: {result['return_id']}")
+        print(f"   Condition: {result['condition']}")
+        print(f"   Status: {result['status']}")
+        if result.get('refund_id'):
+            print(f"   Refund ID: {result['refund_id']}")
+    else:
+        print(f"\n❌ {result.get('error', 'Failed to process return')}")
+
+
+async def _cmd_show_orders(parts: list, agent: Optional[CustomerSupportAgent]):
+    """Print all orders, optionally filtered by status"""
+    db = get_db()
+    if len(parts) > 2:
+        status = parts[2]
+        print(f"\n📦 ORDERS WITH STATUS '{status}':")
+        orders = {order["order_id"]: order for order in db.get_orders_by_status(status)}
+        print(_pretty(orders) if orders else "No matching orders")
+    else:
         print("\n📦 ALL ORDERS:")
-        print(json.dumps(db.orders, indent=2))
+        print(_pretty(db.orders))
+
+
+async def _cmd_show_returns(parts: list, agent: Optional[CustomerSupportAgent]):
+    """Print all returns"""
+    db = get_db()
+    print("\n🔄 ALL RETURNS:")
+    if db.returns:
+        print(_pretty(db.returns))
+    else:
+        print("No returns in system")
+
+
+async def _cmd_show_refunds(parts: list, agent: Optional[CustomerSupportAgent]):
+    """Print all refunds"""
+    db = get_db()
+    print("\n💰 ALL REFUNDS:")
+    if db.refunds:
+        print(_pretty(db.refunds))
+    else:
+        print("No refunds in system")
+
+
+async def _cmd_batch_process(parts: list, agent: Optional[CustomerSupportAgent]):
+    """Receive many returns from a JSONL file, optionally summarizing them with the LLM"""
+    mode = parts[3] if len(parts) > 3 else None
+    if len(parts) < 3 or mode not in (None, "batch", "realtime"):
+        print("❌ Usage: /admin batch_process <file> [batch|realtime]")
+        print("   File: JSONL rows of {\"return_id\": ..., \"condition\": ...}")
+        print("   Add 'batch' (Batch API) or 'realtime' (parallel calls) for LLM summaries")
+        return
     
-    elif action == "show_returns":
-        print("\n🔄 ALL RETURNS:")
-        if db.returns:
-            print(json.dumps(db.returns, indent=2))
-        else:
-            print("No returns in system")
+    try:
+        async with get_db().lock:
+            results = await process_returns_file(parts[2])
+    except OSError as e:
+        print(f"❌ Could not read {parts[2]}: {e}")
+        return
     
-    elif action == "show_refunds":
-        print("\n💰 ALL REFUNDS:")
-        if db.refunds:
-            print(json.dumps(db.refunds, indent=2))
-        else:
-            print("No refunds in system")
+    approved = sum(1 for r in results if r.get("status") == "approved")
+    rejected = sum(1 for r in results if r.get("status") == "rejected")
+    print(f"\n📦 Processed {len(results)} returns: {approved} approved, {rejected} rejected, "
+          f"{len(results) - approved - rejected} failed")
+    for result in results:
+        if "status" not in result:
+            print(f"   ❌ {result.get('error', 'Failed to process return')}")
+    
+    if not mode or not agent:
+        return
+    
+    if mode == "batch":
+        # Batches can take up to 24h; submit now and let the admin check back
+        batch_id = await submit_summary_batch(agent.client, agent.model, results)
+        if batch_id:
+            print(f"📤 Submitted batch {batch_id}; check it with /admin batch_status {batch_id}")
+        return
+    
+    summaries = await summarize_realtime(agent.client, agent.model, results)
+    for return_id, summary in summaries.items():
+        print(f"   📝 {return_id}: {summary}")
+
+
+async def _cmd_batch_status(parts: list, agent: Optional[CustomerSupportAgent]):
+    """Check a summary batch and print its summaries once it has completed"""
+    if len(parts) < 3:
+        print("❌ Usage: /admin batch_status <batch_id>")
+        return
+    if not agent:
+        print("❌ batch_status needs a running agent")
+        return
     
-    elif action == "reset_database":
+    batch_id = parts[2]
+    try:
+        status, summaries = await fetch_batch_summaries(agent.client, batch_id)
+    except Exception as e:
+        print(f"❌ Could not check batch {batch_id}: {e}")
+        return
+    
+    if status != "completed":
+        print(f"⏳ Batch {batch_id} is {status}")
+        return
+    print(f"\n📥 Batch {batch_id} completed with {len(summaries)} summaries")
+    for return_id, summary in summaries.items():
+        print(f"   📝 {return_id}: {summary}")
+
+
+async def _cmd_reset_database(parts: list, agent: Optional[CustomerSupportAgent]):
+    """Reset the database to the sample orders"""
+    db = get_db()
+    async with db.lock:
         db.reset()
-        print("\n✅ Database reset to initial state (10 sample orders)")
+    print("\n✅ Database reset to initial state (10 sample orders)")
+
+
+# Admin command name -> handler(parts, agent)
+ADMIN_COMMANDS = {
+    "receive_return": _cmd_receive_return,
+    "show_orders": _cmd_show_orders,
+    "show_returns": _cmd_show_returns,
+    "show_refunds": _cmd_show_refunds,
+    "batch_process": _cmd_batch_process,
+    "batch_status": _cmd_batch_status,
+    "reset_database": _cmd_reset_database
+}
+
+
+async def handle_admin_command(command: str, agent: Optional[CustomerSupportAgent] = None):
+    """Handle admin commands for simulation"""
+    parts = command.split()
     
-    else:
-        print(f"❌ Unknown admin command: {action}")
-        print("\nAvailable commands:")
-        print("  /admin receive_return <return_id> <condition>")
-        print("  /admin show_orders")
-        print("  /admin show_returns")
-        print("  /admin show_refunds")
-        print("  /admin reset_database")
+    if len(parts) < 2:
+        print("❌ Invalid admin command")
+        print(ADMIN_HELP)
+        return
+    
+    handler = ADMIN_COMMANDS.get(parts[1])
+    if not handler:
+        print(f"❌ Unknown admin command: {parts[1]}")
+        print(ADMIN_HELP)
+        return
+    
+    await handler(parts, agent)
+
+
+async def _ainput(prompt: str) -> str:
+    """
+    Read a line from stdin without blocking the event loop.
+    Uses a daemon thread so a pending read never delays shutdown.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    
+    def read():
+        try:
+            line = input(prompt)
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(line))
+        except BaseException as e:
+            loop.call_soon_threadsafe(lambda error=e: future.done() or future.set_exception(error))
+    
+    threading.Thread(target=read, daemon=True).start()
+    return await future
 
 
-def main():
+BANNER = "\n".join([
+    "",
+    "=" * 60,
+    "🤖 SHOPCO CUSTOMER SUPPORT AGENT v2.0",
+    "=" * 60,
+    "\nHello! I'm here to help with your orders, shipping, and returns.",
+    "\n📝 REGULAR COMMANDS:",
+    "  - Type your question normally",
+    "  - 'reset' - start a new conversation",
+    "  - 'quit' or 'exit' - end session",
+    "\n🔧 ADMIN COMMANDS (for simulation):",
+    "  - '/admin receive_return RET-12345 good' - mark return as received",
+    "  - '/admin show_orders' - view all orders (optionally filter by status)",
+    "  - '/admin show_returns' - view all returns",
+    "  - '/admin show_refunds' - view all refunds",
+    "  - '/admin batch_process returns.jsonl' - receive many returns from a file",
+    "  - '/admin batch_status <batch_id>' - check a summary batch and print its results",
+    "  - '/admin reset_database' - reset to initial state",
+    "\n💡 TIP: Try different order IDs (12345, 67890, 11111, etc.)",
+    "   - Some are 'processing' (can cancel directly)",
+    "   - Some are 'shipped' or 'delivered' (need return process)",
+    "\n" + "=" * 60 + "\n"
+])
+
+
+async def main():
     """
     Main function to run the agent in terminal
     """
-    print("\n" + "="*60)
-    print("🤖 SHOPCO CUSTOMER SUPPORT AGENT v2.0")
-    print("="*60)
-    print("\nHello! I'm here to help with your orders, shipping, and returns.")
-    print("\n📝 REGULAR COMMANDS:")
-    print("  - Type your question normally")
-    print("  - 'reset' - start a new conversation")
-    print("  - 'quit' or 'exit' - end session")
-    print("\n🔧 ADMIN COMMANDS (for simulation):")
-    print("  - '/admin receive_return RET-12345 good' - mark return as received")
-    print("  - '/admin show_orders' - view all orders")
-    print("  - '/admin show_returns' - view all returns")
-    print("  - '/admin show_refunds' - view all refunds")
-    print("  - '/admin reset_database' - reset to initial state")
-    print("\n💡 TIP: Try different order IDs (12345, 67890, 11111, etc.)")
-    print("   - Some are 'processing' (can cancel directly)")
-    print("   - Some are 'shipped' or 'delivered' (need return process)")
-    print("\n" + "="*60 + "\n")
+    parser = argparse.ArgumentParser(description="ShopCo customer support agent")
+    parser.add_argument("--quiet", action="store_true", help="hide step-by-step debug output")
+    args = parser.parse_args()
+    
+    # Interactive terminals get every chunk immediately; piped/replayed runs
+    # buffer stdout (including UI log output) and only flush when the buffer fills
+    interactive = sys.stdout.isatty()
+    if not interactive:
+        sys.stdout.reconfigure(line_buffering=False, write_through=False)
+    
+    configure_logging(quiet=args.quiet, buffered=not interactive)
+    
+    print(BANNER)
     
     agent = CustomerSupportAgent()
     
     while True:
         try:
-            # Get user input
-            user_input = input("YOU: ").strip()
+            # Get user input (off the event loop so in-flight requests keep progressing)
+            user_input = (await _ainput("YOU: ")).strip()
             
             if not user_input:
                 continue
             
             # Check for admin commands
             if user_input.startswith('/admin'):
-                handle_admin_command(user_input)
+                await handle_admin_command(user_input, agent)
                 continue
             
             if user_input.lower() in ['quit', 'exit', 'bye', 'goodbye']:
@@ -323,19 +823,34 @@ def main():
                 agent.reset()
                 continue
             
-            # Get agent response
-            response = agent.chat(user_input)
+            # Get agent response, printing streamed text as it arrives
+            streamed = []
+            
+            def print_token(delta: str):
+                if not streamed:
+                    print("\nAGENT: ", end="", flush=interactive)
+                streamed.append(delta)
+                print(delta, end="", flush=interactive)
             
-            # Print response
-            print(f"\nAGENT: {response}\n")
+            response = await agent.chat(user_input, on_token=print_token)
             
-        except KeyboardInterrupt:
+            # Print response (unless it was already streamed)
+            if streamed:
+                print("\n")
+            else:
+                print(f"\nAGENT: {response}\n")
+            
+        except (KeyboardInterrupt, EOFError, asyncio.CancelledError):
             print("\n\nGoodbye! 👋\n")
             break
         except Exception as e:
             print(f"\n❌ Unexpected error: {e}\n")
             print("Please try again or type 'quit' to exit.\n")
+    
+    # Finish queued database writes and close pooled connections while the event loop is still running
+    await drain_background_writes()
+    await agent.client.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,116 @@
+# batch.py
+import asyncio
+import orjson
+from typing import Dict, List, Optional, Tuple
+from functions import process_return_receipt
+from log_config import ui_logger
+from ratelimit import rate_limiter, count_message_tokens, with_retries
+
+SUMMARY_PROMPT = "You write short customer-facing notes about processed returns. Summarize the result in 1-2 sentences."
+
+
+async def process_returns_file(path: str) -> List[Dict]:
+    """
+    Run process_return_receipt for every row of a JSONL file.
+    Each row looks like: {"return_id": "RET-12345", "condition": "good"}
+    """
+    results = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = orjson.loads(line)
+                result = await process_return_receipt(row["return_id"], row.get("condition", "good"))
+            except (ValueError, KeyError, TypeError) as e:
+                result = {"success": False, "error": f"Invalid row on line {line_number}: {e}"}
+            results.append(result)
+    return results
+
+
+def _summary_body(model: str, result: Dict) -> Dict:
+    """Chat completion request body asking for a summary of one result"""
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": orjson.dumps(result).decode()}
+        ],
+        "temperature": 0
+    }
+
+
+async def submit_summary_batch(client, model: str, results: List[Dict]) -> Optional[str]:
+    """
+    Submit summaries of results to the OpenAI Batch API (half price, 24h window).
+    Returns the batch ID to check later with fetch_batch_summaries (None if nothing to summarize).
+    """
+    lines = [
+        orjson.dumps({
+            "custom_id": result["return_id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": _summary_body(model, result)
+        })
+        for result in results if result.get("return_id")
+    ]
+    if not lines:
+        return None
+
+    batch_file = await client.files.create(
+        file=("returns_batch.jsonl", b"\n".join(lines)),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return batch.id
+
+
+async def fetch_batch_summaries(client, batch_id: str) -> Tuple[str, Dict[str, str]]:
+    """
+    Check a summary batch once.
+    Returns (status, {return_id: summary}); summaries are empty until the batch has completed.
+    """
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status != "completed" or not batch.output_file_id:
+        return batch.status, {}
+
+    output = await client.files.content(batch.output_file_id)
+    summaries = {}
+    for line in output.text.splitlines():
+        record = orjson.loads(line)
+        response = record.get("response") or {}
+        if response.get("status_code") == 200:
+            summaries[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return batch.status, summaries
+
+
+async def summarize_realtime(client, model: str, results: List[Dict], max_concurrency: int = 10) -> Dict[str, str]:
+    """
+    Summarize results with concurrent chat completions (for when the batch window is too long).
+    Returns {return_id: summary}.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def summarize(result: Dict):
+        body = _summary_body(model, result)
+        tokens = count_message_tokens(model, body["messages"])
+
+        async def call():
+            await rate_limiter.acquire(tokens)
+            return await client.chat.completions.create(**body)
+
+        async with semaphore:
+            try:
+                response = await with_retries(call)
+                return result["return_id"], response.choices[0].message.content
+            except Exception as e:
+                ui_logger.error("❌ Summary failed for %s: %s", result["return_id"], e)
+                return result["return_id"], None
+
+    pairs = await asyncio.gather(*[summarize(r) for r in results if r.get("return_id")])
+    return {return_id: summary for return_id, summary in pairs if summary}
@@ -0,0 +1,65 @@
+# cache.py
+import math
+import time
+from typing import Dict, List, Optional
+
+class SemanticCache:
+    """
+    Semantic response cache for repeated support questions.
+    Entries are scoped by order ID and matched by cosine similarity
+    of the question embeddings.
+    """
+    def __init__(self, threshold: float = 0.9, ttl_seconds: float = 600.0, max_entries_per_order: int = 32):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries_per_order = max_entries_per_order
+        # Format: order_id -> [{"embedding", "response", "function_name", "created_at"}]
+        self.entries: Dict[str, List[dict]] = {}
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> List[float]:
+        """Scale embedding to unit length so cosine similarity is a dot product"""
+        norm = math.sqrt(sum(x * x for x in embedding)) or 1.0
+        return [x / norm for x in embedding]
+
+    def get(self, order_id: str, embedding: List[float]) -> Optional[str]:
+        """Return the cached response most similar to the query, if above threshold"""
+        entries = self.entries.get(order_id)
+        if not entries:
+            return None
+
+        # Drop expired entries for this order
+        now = time.monotonic()
+        entries[:] = [e for e in entries if now - e["created_at"] < self.ttl_seconds]
+
+        query = self._normalize(embedding)
+        best_score, best_response = 0.0, None
+        for entry in entries:
+            score = sum(a * b for a, b in zip(query, entry["embedding"]))
+            if score > best_score:
+                best_score, best_response = score, entry["response"]
+
+        return best_response if best_score >= self.threshold else None
+
+    def set(self, order_id: str, embedding: List[float], response: str, function_name: Optional[str] = None):
+        """Store a response for a question about an order"""
+        entries = self.entries.setdefault(order_id, [])
+        entries.append({
+            "embedding": self._normalize(embedding),
+            "response": response,
+            "function_name": function_name,
+            "created_at": time.monotonic()
+        })
+        if len(entries) > self.max_entries_per_order:
+            del entries[0]
+
+    def invalidate_order(self, order_id: Optional[str]):
+        """Drop cached responses for an order (or everything if order_id is None)"""
+        if order_id is None:
+            self.entries = {}
+        else:
+            self.entries.pop(order_id, None)
+
+
+# Global cache instance
+response_cache = SemanticCache()
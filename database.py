@@ -1,143 +1,283 @@
 # database.py
-from datetime import datetime, timedelta
-from typing import Dict, Optional
+import os
+import time
+import atexit
+import asyncio
+import threading
+import msgpack
+from datetime import date, timedelta
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Read-only template for the 10 sample orders; copied into the database on reset
+SAMPLE_ORDERS = (
+    MappingProxyType({
+        "order_id": "12345",
+        "status": "shipped",
+        "items": ("Blue Widget", "Red Gadget"),
+        "order_date": "2025-09-25",
+        "shipped_date": "2025-09-26",
+        "expected_delivery": "2025-10-05",
+        "tracking_number": "1Z999AA10123456784",
+        "total": 89.99,
+        "customer_id": "CUST001"
+    }),
+    MappingProxyType({
+        "order_id": "67890",
+        "status": "processing",
+        "items": ("Green Doohickey",),
+        "order_date": "2025-10-01",
+        "shipped_date": None,
+        "expected_delivery": "2025-10-08",
+        "tracking_number": None,
+        "total": 45.50,
+        "customer_id": "CUST002"
+    }),
+    MappingProxyType({
+        "order_id": "11111",
+        "status": "delivered",
+        "items": ("Purple Thingamajig",),
+        "order_date": "2025-09-20",
+        "shipped_date": "2025-09-21",
+        "expected_delivery": "2025-09-25",
+        "tracking_number": "1Z999AA10987654321",
+        "total": 129.99,
+        "customer_id": "CUST003",
+        "delivered_date": "2025-09-24"
+    }),
+    MappingProxyType({
+        "order_id": "22222",
+        "status": "shipped",
+        "items": ("Yellow Contraption", "Orange Widget"),
+        "order_date": "2025-09-28",
+        "shipped_date": "2025-09-29",
+        "expected_delivery": "2025-10-06",
+        "tracking_number": "1Z999AA11122233344",
+        "total": 199.99,
+        "customer_id": "CUST004"
+    }),
+    MappingProxyType({
+        "order_id": "33333",
+        "status": "processing",
+        "items": ("Silver Gadget",),
+        "order_date": "2025-10-02",
+        "shipped_date": None,
+        "expected_delivery": "2025-10-09",
+        "tracking_number": None,
+        "total": 75.00,
+        "customer_id": "CUST005"
+    }),
+    MappingProxyType({
+        "order_id": "44444",
+        "status": "delivered",
+        "items": ("Gold Device", "Platinum Tool"),
+        "order_date": "2025-09-15",
+        "shipped_date": "2025-09-16",
+        "expected_delivery": "2025-09-20",
+        "tracking_number": "1Z999AA55566677788",
+        "total": 299.99,
+        "customer_id": "CUST006",
+        "delivered_date": "2025-09-19"
+    }),
+    MappingProxyType({
+        "order_id": "55555",
+        "status": "shipped",
+        "items": ("Black Instrument",),
+        "order_date": "2025-09-30",
+        "shipped_date": "2025-10-01",
+        "expected_delivery": "2025-10-07",
+        "tracking_number": "1Z999AA99900011122",
+        "total": 149.99,
+        "customer_id": "CUST007"
+    }),
+    MappingProxyType({
+        "order_id": "66666",
+        "status": "processing",
+        "items": ("White Apparatus", "Gray Component"),
+        "order_date": "2025-10-03",
+        "shipped_date": None,
+        "expected_delivery": "2025-10-10",
+        "tracking_number": None,
+        "total": 225.50,
+        "customer_id": "CUST008"
+    }),
+    MappingProxyType({
+        "order_id": "77777",
+        "status": "delivered",
+        "items": ("Brown Mechanism",),
+        "order_date": "2025-09-10",
+        "shipped_date": "2025-09-11",
+        "expected_delivery": "2025-09-15",
+        "tracking_number": "1Z999AA33344455566",
+        "total": 89.99,
+        "customer_id": "CUST009",
+        "delivered_date": "2025-09-14"
+    }),
+    MappingProxyType({
+        "order_id": "88888",
+        "status": "shipped",
+        "items": ("Pink Accessory", "Teal Fixture", "Cyan Part"),
+        "order_date": "2025-09-27",
+        "shipped_date": "2025-09-28",
+        "expected_delivery": "2025-10-05",
+        "tracking_number": "1Z999AA77788899900",
+        "total": 349.99,
+        "customer_id": "CUST010"
+    })
+)
+
+# Seconds between a change and the background snapshot write
+SNAPSHOT_FLUSH_DELAY = 5.0
+
+# Only orders that have left the warehouse can be returned
+RETURNABLE_STATUSES = ("shipped", "delivered")
+
+# (computed_at, "YYYY-MM-DD") so bulk record creation doesn't format the date each time
+_today_cache: Tuple[float, str] = (0.0, "")
+
+
+def today() -> str:
+    """Today's date as YYYY-MM-DD, recomputed at most once a minute"""
+    global _today_cache
+    now = time.time()
+    computed_at, value = _today_cache
+    if now - computed_at < 60:
+        return value
+    value = date.today().isoformat()
+    _today_cache = (now, value)
+    return value
+
 
 class InMemoryDatabase:
-    def __init__(self):
+    def __init__(self, snapshot_path: Optional[str] = None):
         self.orders = {}
         self.returns = {}
         self.refunds = {}
-        self._initialize_sample_data()
+        # Secondary indexes: order_id -> [return_id/refund_id], status -> {order_id: None} (insertion-ordered)
+        self._returns_by_order: Dict[str, List[str]] = {}
+        self._refunds_by_order: Dict[str, List[str]] = {}
+        self._orders_by_status: Dict[str, Dict[str, None]] = {}
+        # Callbacks notified with an order_id whenever that order's data changes
+        self._change_listeners: List[Callable[[Optional[str]], None]] = []
+        self._lock: Optional[asyncio.Lock] = None
+        
+        # Optional msgpack snapshot: loaded on startup, rewritten shortly after changes
+        self.snapshot_path = snapshot_path
+        self._dirty = False
+        self._flush_timer: Optional[threading.Timer] = None
+        self._flush_lock = threading.Lock()
+        
+        if snapshot_path and os.path.exists(snapshot_path):
+            self.load(snapshot_path)
+        else:
+            self._initialize_sample_data()
+        
+        if snapshot_path:
+            atexit.register(self.flush)
+    
+    @property
+    def lock(self) -> asyncio.Lock:
+        """
+        Lock for async callers to hold around multi-step read/modify/write
+        sequences, so concurrent sessions don't interleave mutations.
+        Created on first use so it binds to the running event loop.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+    
+    def add_change_listener(self, callback: Callable[[Optional[str]], None]):
+        """Register a callback for data changes (order_id is None on full reset); repeats are ignored"""
+        if callback not in self._change_listeners:
+            self._change_listeners.append(callback)
+    
+    def _notify_change(self, order_id: Optional[str]):
+        """Notify listeners that data for an order changed"""
+        self._mark_dirty()
+        for callback in self._change_listeners:
+            callback(order_id)
+    
+    def _mark_dirty(self):
+        """Schedule a background snapshot write (if persistence is enabled)"""
+        if not self.snapshot_path:
+            return
+        self._dirty = True
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(SNAPSHOT_FLUSH_DELAY, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+    
+    def flush(self):
+        """Write pending changes to the snapshot file"""
+        with self._flush_lock:
+            self._flush_timer = None
+            if self._dirty and self.snapshot_path:
+                self._dirty = False
+                self.save(self.snapshot_path)
+    
+    def save(self, path: str):
+        """Save orders, returns and refunds to a msgpack snapshot"""
+        data = msgpack.packb({
+            "orders": self.orders,
+            "returns": self.returns,
+            "refunds": self.refunds
+        }, use_bin_type=True)
+        # Write to a temp file first so a crash never leaves a half-written snapshot
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    
+    def load(self, path: str):
+        """Load orders, returns and refunds from a msgpack snapshot and rebuild indexes"""
+        with open(path, "rb") as f:
+            data = msgpack.unpackb(f.read(), raw=False)
+        self.orders = data["orders"]
+        self.returns = data["returns"]
+        self.refunds = data["refunds"]
+        
+        self._orders_by_status = {}
+        for order_id, order in self.orders.items():
+            self._orders_by_status.setdefault(order["status"], {})[order_id] = None
+        self._returns_by_order = {}
+        for return_id, return_record in self.returns.items():
+            self._index_add(self._returns_by_order, return_record["order_id"], return_id)
+        self._refunds_by_order = {}
+        for refund_id, refund in self.refunds.items():
+            self._index_add(self._refunds_by_order, refund["order_id"], refund_id)
     
     def _initialize_sample_data(self):
         """Pre-populate with 10 sample orders"""
-        sample_orders = [
-            {
-                "order_id": "12345",
-                "status": "shipped",
-                "items": ["Blue Widget", "Red Gadget"],
-                "order_date": "2025-09-25",
-                "shipped_date": "2025-09-26",
-                "expected_delivery": "2025-10-05",
-                "tracking_number": "1Z999AA10123456784",
-                "total": 89.99,
-                "customer_id": "CUST001"
-            },
-            {
-                "order_id": "67890",
-                "status": "processing",
-                "items": ["Green Doohickey"],
-                "order_date": "2025-10-01",
-                "shipped_date": None,
-                "expected_delivery": "2025-10-08",
-                "tracking_number": None,
-                "total": 45.50,
-                "customer_id": "CUST002"
-            },
-            {
-                "order_id": "11111",
-                "status": "delivered",
-                "items": ["Purple Thingamajig"],
-                "order_date": "2025-09-20",
-                "shipped_date": "2025-09-21",
-                "expected_delivery": "2025-09-25",
-                "tracking_number": "1Z999AA10987654321",
-                "total": 129.99,
-                "customer_id": "CUST003",
-                "delivered_date": "2025-09-24"
-            },
-            {
-                "order_id": "22222",
-                "status": "shipped",
-                "items": ["Yellow Contraption", "Orange Widget"],
-                "order_date": "2025-09-28",
-                "shipped_date": "2025-09-29",
-                "expected_delivery": "2025-10-06",
-                "tracking_number": "1Z999AA11122233344",
-                "total": 199.99,
-                "customer_id": "CUST004"
-            },
-            {
-                "order_id": "33333",
-                "status": "processing",
-                "items": ["Silver Gadget"],
-                "order_date": "2025-10-02",
-                "shipped_date": None,
-                "expected_delivery": "2025-10-09",
-                "tracking_number": None,
-                "total": 75.00,
-                "customer_id": "CUST005"
-            },
-            {
-                "order_id": "44444",
-                "status": "delivered",
-                "items": ["Gold Device", "Platinum Tool"],
-                "order_date": "2025-09-15",
-                "shipped_date": "2025-09-16",
-                "expected_delivery": "2025-09-20",
-                "tracking_number": "1Z999AA55566677788",
-                "total": 299.99,
-                "customer_id": "CUST006",
-                "delivered_date": "2025-09-19"
-            },
-            {
-                "order_id": "55555",
-                "status": "shipped",
-                "items": ["Black Instrument"],
-                "order_date": "2025-09-30",
-                "shipped_date": "2025-10-01",
-                "expected_delivery": "2025-10-07",
-                "tracking_number": "1Z999AA99900011122",
-                "total": 149.99,
-                "customer_id": "CUST007"
-            },
-            {
-                "order_id": "66666",
-                "status": "processing",
-                "items": ["White Apparatus", "Gray Component"],
-                "order_date": "2025-10-03",
-                "shipped_date": None,
-                "expected_delivery": "2025-10-10",
-                "tracking_number": None,
-                "total": 225.50,
-                "customer_id": "CUST008"
-            },
-            {
-                "order_id": "77777",
-                "status": "delivered",
-                "items": ["Brown Mechanism"],
-                "order_date": "2025-09-10",
-                "shipped_date": "2025-09-11",
-                "expected_delivery": "2025-09-15",
-                "tracking_number": "1Z999AA33344455566",
-                "total": 89.99,
-                "customer_id": "CUST009",
-                "delivered_date": "2025-09-14"
-            },
-            {
-                "order_id": "88888",
-                "status": "shipped",
-                "items": ["Pink Accessory", "Teal Fixture", "Cyan Part"],
-                "order_date": "2025-09-27",
-                "shipped_date": "2025-09-28",
-                "expected_delivery": "2025-10-05",
-                "tracking_number": "1Z999AA77788899900",
-                "total": 349.99,
-                "customer_id": "CUST010"
-            }
-        ]
-        
-        for order in sample_orders:
+        for template in SAMPLE_ORDERS:
+            # Shallow copy per reset; items is the only nested value
+            order = {**template, "items": list(template["items"])}
             self.orders[order["order_id"]] = order
+            self._orders_by_status.setdefault(order["status"], {})[order["order_id"]] = None
+    
+    @staticmethod
+    def _index_add(index: Dict[str, List[str]], key: str, record_id: str):
+        """Add a record ID to a secondary index without duplicates"""
+        ids = index.setdefault(key, [])
+        if record_id not in ids:
+            ids.append(record_id)
     
     def get_order(self, order_id: str) -> Optional[Dict]:
         """Get order by ID"""
         return self.orders.get(order_id)
     
+    def get_orders_by_status(self, status: str) -> List[Dict]:
+        """Get all orders with a given status"""
+        return [self.orders[order_id] for order_id in self._orders_by_status.get(status, ())]
+    
     def update_order_status(self, order_id: str, new_status: str) -> bool:
         """Update order status"""
         if order_id in self.orders:
+            old_status = self.orders[order_id]["status"]
+            self._orders_by_status.get(old_status, {}).pop(order_id, None)
+            self._orders_by_status.setdefault(new_status, {})[order_id] = None
             self.orders[order_id]["status"] = new_status
+            self._notify_change(order_id)
             return True
         return False
     
@@ -149,13 +289,38 @@ class InMemoryDatabase:
             "order_id": order_id,
             "status": "pending_receipt",
             "reason": reason,
-            "initiated_date": datetime.now().strftime("%Y-%m-%d"),
+            "initiated_date": today(),
             "received_date": None,
             "inspection_result": None,
             "refund_id": None
         }
+        self._index_add(self._returns_by_order, order_id, return_id)
+        self._notify_change(order_id)
+        return return_id
+    
+    def initiate_return(self, order_id: str, reason: str) -> Optional[str]:
+        """
+        Create a return and mark the order return_requested in one step.
+        Returns None if the order is missing or not in a returnable status.
+        """
+        order = self.orders.get(order_id)
+        if order is None or order["status"] not in RETURNABLE_STATUSES:
+            return None
+        return_id = self.create_return(order_id, reason)
+        self.update_order_status(order_id, "return_requested")
         return return_id
     
+    def initiate_refund_with_return(self, order_id: str, amount: float, reason: str) -> Optional[Tuple[str, str]]:
+        """
+        Create a return and its linked refund for a shipped/delivered order in one step.
+        Returns (return_id, refund_id), or None if the order cannot be returned.
+        """
+        return_id = self.initiate_return(order_id, reason)
+        if return_id is None:
+            return None
+        refund_id = self.create_refund(order_id, amount, reason, return_id)
+        return return_id, refund_id
+    
     def get_return(self, return_id: str) -> Optional[Dict]:
         """Get return by ID"""
         return self.returns.get(return_id)
@@ -166,6 +331,7 @@ class InMemoryDatabase:
             self.returns[return_id]["status"] = new_status
             for key, value in kwargs.items():
                 self.returns[return_id][key] = value
+            self._notify_change(self.returns[return_id]["order_id"])
             return True
         return False
     
@@ -178,22 +344,80 @@ class InMemoryDatabase:
             "amount": amount,
             "reason": reason,
             "status": "pending_return" if return_id else "processing",
-            "initiated_date": datetime.now().strftime("%Y-%m-%d"),
+            "initiated_date": today(),
             "completed_date": None,
             "return_id": return_id
         }
+        self._index_add(self._refunds_by_order, order_id, refund_id)
+        self._notify_change(order_id)
         return refund_id
     
+    def create_refund_processing(self, order_id: str, amount: float, reason: str) -> str:
+        """Cancel an order and create its refund already in processing, in one step"""
+        self.update_order_status(order_id, "cancelled")
+        return self.create_refund(order_id, amount, reason)
+    
     def get_refund(self, refund_id: str) -> Optional[Dict]:
         """Get refund by ID"""
         return self.refunds.get(refund_id)
     
+    @staticmethod
+    def _latest(index: Dict[str, List[str]], records: Dict[str, Dict], order_id: str) -> Optional[Dict]:
+        """Most recent record for an order from a secondary index"""
+        ids = index.get(order_id)
+        return records[ids[-1]] if ids else None
+    
+    def get_return_by_order(self, order_id: str) -> Optional[Dict]:
+        """Get the most recent return for an order"""
+        return self._latest(self._returns_by_order, self.returns, order_id)
+    
+    def get_refund_by_order(self, order_id: str) -> Optional[Dict]:
+        """Get the most recent refund for an order"""
+        return self._latest(self._refunds_by_order, self.refunds, order_id)
+    
+    def get_order_bundle(self, order_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Get orders together with their return and refund in a single call.
+        Returns {order_id: {"order", "return", "refund"}} for orders that exist;
+        the order is a copy the caller may modify.
+        """
+        bundles = {}
+        for order_id in order_ids:
+            order = self.orders.get(order_id)
+            if order is not None:
+                bundles[order_id] = {
+                    # items is the only nested value
+                    "order": {**order, "items": list(order["items"])},
+                    "return": self.get_return_by_order(order_id),
+                    "refund": self.get_refund_by_order(order_id)
+                }
+        return bundles
+    
+    def get_return_bundle(self, return_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Get returns together with their order and refund in a single call.
+        Returns {return_id: {"return", "order", "refund"}} for returns that exist;
+        the return is a copy the caller may modify.
+        """
+        bundles = {}
+        for return_id in return_ids:
+            return_record = self.returns.get(return_id)
+            if return_record is not None:
+                order_id = return_record["order_id"]
+                bundles[return_id] = {
+                    "return": dict(return_record),
+                    "order": self.orders.get(order_id),
+                    "refund": self.get_refund_by_order(order_id)
+                }
+        return bundles
+    
     def update_refund_status(self, refund_id: str, new_status: str, **kwargs) -> bool:
         """Update refund status"""
         if refund_id in self.refunds:
             self.refunds[refund_id]["status"] = new_status
             for key, value in kwargs.items():
                 self.refunds[refund_id][key] = value
+            self._notify_change(self.refunds[refund_id]["order_id"])
             return True
         return False
     
@@ -202,8 +426,17 @@ class InMemoryDatabase:
         self.orders = {}
         self.returns = {}
         self.refunds = {}
+        self._returns_by_order = {}
+        self._refunds_by_order = {}
+        self._orders_by_status = {}
         self._initialize_sample_data()
+        self._notify_change(None)
 
 
-# Global database instance
-db = InMemoryDatabase()
\ No newline at end of file
+@lru_cache(maxsize=None)
+def get_db() -> InMemoryDatabase:
+    """
+    Shared database instance, created (and seeded) on first use.
+    Set DB_SNAPSHOT_PATH to persist data across restarts.
+    """
+    return InMemoryDatabase(snapshot_path=os.getenv("DB_SNAPSHOT_PATH"))
\ No newline at end of file
@@ -1,29 +1,50 @@
 # functions.py
-from database import db
-from datetime import datetime
+import asyncio
+import logging
+from database import get_db, today, RETURNABLE_STATUSES
+from types import MappingProxyType
+from typing import Awaitable, Callable, Dict
 
-def check_order_status(order_id: str) -> dict:
+logger = logging.getLogger("agent")
+
+# Inspection results that still qualify for a refund (minor damage is accepted)
+ACCEPTED_CONDITIONS = ("good", "damaged")
+
+# Follow-up writes running off the request path, keyed by idempotency key (the return_id)
+_pending_writes: Dict[str, asyncio.Task] = {}
+
+RETURN_INSTRUCTIONS = "Pack item securely, attach label, drop off at any FedEx location. Refund will be processed within 3-5 business days after we receive and inspect the item."
+
+
+def _return_label(order_id: str) -> str:
+    """Generate mock return shipping label"""
+    return f"RETURN-LABEL-{order_id}-{today().replace('-', '')}"
+
+
+async def check_order_status(order_id: str) -> dict:
     """
     Check order status from database.
     Now returns live data that reflects refunds, returns, etc.
     """
-    order = db.get_order(order_id)
-    
-    if not order:
+    # Fetch order, return and refund together
+    bundle = get_db().get_order_bundle([order_id]).get(order_id)
+    return _order_status_result(order_id, bundle)
+
+
+def _order_status_result(order_id: str, bundle: dict) -> dict:
+    """Build the check_order_status response from an order bundle"""
+    if not bundle:
         return {
             "error": f"Order {order_id} not found in our system",
             "success": False
         }
     
-    # Include return info if exists
-    return_id = f"RET-{order_id}"
-    return_info = db.get_return(return_id)
+    return_info = bundle["return"]
+    refund_info = bundle["refund"]
     
-    # Include refund info if exists
-    refund_id = f"REF-{order_id}"
-    refund_info = db.get_refund(refund_id)
-    
-    result = {**order, "success": True}
+    # The bundle's order is already a copy, so fill it in place
+    result = bundle["order"]
+    result["success"] = True
     
     if return_info:
         result["return_info"] = return_info
@@ -34,104 +55,146 @@ def check_order_status(order_id: str) -> dict:
     return result
 
 
-def check_tracking(tracking_number: str) -> dict:
+async def check_order_status_batch(order_ids: list) -> dict:
     """
-    Mock function to check tracking status.
-    In production, this would call FedEx/UPS/USPS APIs.
+    Check the status of several orders in one call.
+    Results are returned in the order the IDs were requested.
     """
+    bundles = get_db().get_order_bundle(order_ids)
     return {
-        "tracking_number": tracking_number,
-        "carrier": "FedEx",
-        "status": "In Transit",
-        "location": "Portland, OR",
-        "last_update": "2025-10-03 14:30",
-        "expected_delivery": "2025-10-05",
-        "history": [
-            {"date": "2025-10-01 09:00", "location": "Seattle, WA", "event": "Package picked up"},
-            {"date": "2025-10-02 15:30", "location": "Seattle, WA", "event": "Departed facility"},
-            {"date": "2025-10-03 08:15", "location": "Portland, OR", "event": "Arrived at facility"},
-            {"date": "2025-10-03 14:30", "location": "Portland, OR", "event": "In transit to destination"}
-        ]
+        "success": True,
+        "orders": [_order_status_result(order_id, bundles.get(order_id)) for order_id in order_ids]
     }
 
 
-def initiate_return(order_id: str, reason: str) -> dict:
+# Mock tracking data, built once and shared by every check_tracking response
+# (callers must not mutate tool results; they are only serialized for the model)
+_TRACKING_BASE = MappingProxyType({
+    "carrier": "FedEx",
+    "status": "In Transit",
+    "location": "Portland, OR",
+    "last_update": "2025-10-03 14:30",
+    "expected_delivery": "2025-10-05"
+})
+_TRACKING_HISTORY = (
+    {"date": "2025-10-01 09:00", "location": "Seattle, WA", "event": "Package picked up"},
+    {"date": "2025-10-02 15:30", "location": "Seattle, WA", "event": "Departed facility"},
+    {"date": "2025-10-03 08:15", "location": "Portland, OR", "event": "Arrived at facility"},
+    {"date": "2025-10-03 14:30", "location": "Portland, OR", "event": "In transit to destination"}
+)
+
+
+async def check_tracking(tracking_number: str) -> dict:
+    """
+    Mock function to check tracking status.
+    In production, this would call FedEx/UPS/USPS APIs.
     """
-    Initiate return process for shipped/delivered orders.
-    Creates return record and updates order status.
+    return {"tracking_number": tracking_number, **_TRACKING_BASE, "history": _TRACKING_HISTORY}
+
+
+async def check_return_status(return_id: str) -> dict:
     """
-    order = db.get_order(order_id)
+    Check status of a return.
+    """
+    # Let a just-submitted approval/rejection land first so the status is current
+    await _wait_for_write(return_id)
     
-    if not order:
-        return {
-            "success": False,
-            "error": f"Order {order_id} not found"
-        }
+    # Fetch return with its associated order and refund together
+    bundle = get_db().get_return_bundle([return_id]).get(return_id)
     
-    # Business rule: can only return shipped or delivered orders
-    if order["status"] not in ["shipped", "delivered"]:
+    if not bundle:
         return {
             "success": False,
-            "error": f"Cannot initiate return for order with status: {order['status']}. Order must be shipped or delivered."
+            "error": f"Return {return_id} not found"
         }
     
-    # Create return record
-    return_id = db.create_return(order_id, reason)
+    order = bundle["order"]
+    refund = bundle["refund"]
     
-    # Update order status
-    db.update_order_status(order_id, "return_requested")
+    # The bundle's return is already a copy, so fill it in place
+    result = bundle["return"]
+    result["success"] = True
+    result["order_total"] = order["total"] if order else None
+    
+    if refund:
+        result["refund_info"] = refund
     
-    # Generate mock return shipping label
-    return_label = f"RETURN-LABEL-{order_id}-{datetime.now().strftime('%Y%m%d')}"
+    return result
+
+
+def _refund_processing(order: dict, amount: float, reason: str) -> dict:
+    """Processing orders can be cancelled and refunded immediately"""
+    order_id = order["order_id"]
+    refund_id = get_db().create_refund_processing(order_id, amount, reason)
     
     return {
         "success": True,
-        "return_id": return_id,
+        "refund_id": refund_id,
         "order_id": order_id,
-        "status": "pending_receipt",
-        "message": f"Return initiated successfully. Please ship the item back using the provided label.",
-        "return_shipping_label": return_label,
-        "return_address": "ShopCo Returns, 123 Warehouse St, Seattle, WA 98101",
-        "instructions": "Pack item securely, attach label, drop off at any FedEx location. Refund will be processed within 3-5 business days after we receive and inspect the item.",
-        "estimated_refund_amount": order["total"]
+        "amount": amount,
+        "status": "processing",
+        "message": f"Order cancelled and refund of ${amount:.2f} is processing. Funds will appear in 3-5 business days.",
+        "estimated_days": 3
     }
 
 
-def check_return_status(return_id: str) -> dict:
-    """
-    Check status of a return.
-    """
-    return_record = db.get_return(return_id)
-    
-    if not return_record:
+def _refund_with_return(order: dict, amount: float, reason: str) -> dict:
+    """Shipped/delivered orders need the item returned before the refund"""
+    order_id = order["order_id"]
+    # Create the return, update the order and create the linked refund in one step
+    created = get_db().initiate_refund_with_return(order_id, amount, reason)
+    if created is None:
         return {
             "success": False,
-            "error": f"Return {return_id} not found"
+            "error": f"Cannot initiate return for order with status: {order['status']}. Order must be shipped or delivered."
         }
+    return_id, refund_id = created
     
-    # Get associated order and refund info
-    order = db.get_order(return_record["order_id"])
-    refund_id = f"REF-{return_record['order_id']}"
-    refund = db.get_refund(refund_id)
-    
-    result = {
+    return {
         "success": True,
-        **return_record,
-        "order_total": order["total"] if order else None
+        "refund_id": refund_id,
+        "return_id": return_id,
+        "order_id": order_id,
+        "amount": amount,
+        "status": "pending_return",
+        "message": f"Return initiated. Once we receive and approve the return, we'll process your ${amount:.2f} refund.",
+        "return_instructions": RETURN_INSTRUCTIONS,
+        "return_shipping_label": _return_label(order_id)
     }
-    
-    if refund:
-        result["refund_info"] = refund
-    
-    return result
 
 
-def initiate_refund(order_id: str, amount: float, reason: str) -> dict:
+def _refund_in_progress(order: dict, amount: float, reason: str) -> dict:
+    """A return or refund is already underway"""
+    return {
+        "success": False,
+        "error": f"Refund already in progress for this order. Current status: {order['status']}"
+    }
+
+
+def _refund_unsupported(order: dict, amount: float, reason: str) -> dict:
+    """Any other status cannot be refunded"""
+    return {
+        "success": False,
+        "error": f"Cannot process refund for order with status: {order['status']}"
+    }
+
+
+# Order status -> refund handler (other statuses go to _refund_unsupported)
+REFUND_STATUS_HANDLERS = {
+    "processing": _refund_processing,
+    **{status: _refund_with_return for status in RETURNABLE_STATUSES},
+    "return_requested": _refund_in_progress,
+    "refund_processing": _refund_in_progress
+}
+
+
+async def initiate_refund(order_id: str, amount: float, reason: str) -> dict:
     """
     Smart refund function that handles both:
     1. Direct refunds for processing/cancelled orders
     2. Automatic return initiation for shipped/delivered orders
     """
+    db = get_db()
     order = db.get_order(order_id)
     
     if not order:
@@ -150,60 +213,12 @@ def initiate_refund(order_id: str, amount: float, reason: str) -> dict:
             "amount": amount
         }
     
-    # Check order status to determine refund type
-    if order["status"] == "processing":
-        # Can cancel and refund immediately
-        db.update_order_status(order_id, "cancelled")
-        refund_id = db.create_refund(order_id, amount, reason)
-        db.update_refund_status(refund_id, "processing")
-        
-        return {
-            "success": True,
-            "refund_id": refund_id,
-            "order_id": order_id,
-            "amount": amount,
-            "status": "processing",
-            "message": f"Order cancelled and refund of ${amount:.2f} is processing. Funds will appear in 3-5 business days.",
-            "estimated_days": 3
-        }
-    
-    elif order["status"] in ["shipped", "delivered"]:
-        # Need to initiate return first
-        return_result = initiate_return(order_id, reason)
-        
-        if not return_result["success"]:
-            return return_result
-        
-        # Create refund record linked to return
-        refund_id = db.create_refund(order_id, amount, reason, return_result["return_id"])
-        
-        return {
-            "success": True,
-            "refund_id": refund_id,
-            "return_id": return_result["return_id"],
-            "order_id": order_id,
-            "amount": amount,
-            "status": "pending_return",
-            "message": f"Return initiated. Once we receive and approve the return, we'll process your ${amount:.2f} refund.",
-            "return_instructions": return_result["instructions"],
-            "return_shipping_label": return_result["return_shipping_label"]
-        }
-    
-    elif order["status"] in ["return_requested", "refund_processing"]:
-        # Already in progress
-        return {
-            "success": False,
-            "error": f"Refund already in progress for this order. Current status: {order['status']}"
-        }
-    
-    else:
-        return {
-            "success": False,
-            "error": f"Cannot process refund for order with status: {order['status']}"
-        }
+    # Dispatch on order status to determine refund type
+    handler = REFUND_STATUS_HANDLERS.get(order["status"], _refund_unsupported)
+    return handler(order, amount, reason)
 
 
-def process_return_receipt(return_id: str, condition: str) -> dict:
+async def process_return_receipt(return_id: str, condition: str) -> dict:
     """
     ADMIN/SYSTEM FUNCTION: Process received return.
     Simulates warehouse receiving and inspecting returned item.
@@ -212,6 +227,7 @@ def process_return_receipt(return_id: str, condition: str) -> dict:
         return_id: The return ID
         condition: 'good', 'damaged', or 'damaged_beyond_acceptable'
     """
+    db = get_db()
     return_record = db.get_return(return_id)
     
     if not return_record:
@@ -220,57 +236,44 @@ def process_return_receipt(return_id: str, condition: str) -> dict:
             "error": f"Return {return_id} not found"
         }
     
-    if return_record["status"] != "pending_receipt":
+    if return_record["status"] == "received" and return_id not in _pending_writes:
+        # Receipt was recorded but approval/rejection failed; run it again
+        # with the original inspection result
+        condition = return_record["inspection_result"]
+    
+    elif return_record["status"] != "pending_receipt":
         return {
             "success": False,
             "error": f"Return {return_id} is not pending receipt. Current status: {return_record['status']}"
         }
     
-    # Update return as received
-    db.update_return_status(
-        return_id,
-        "received",
-        received_date=datetime.now().strftime("%Y-%m-%d"),
-        inspection_result=condition
-    )
+    else:
+        # Record the receipt; this is the only write the response depends on
+        db.update_return_status(
+            return_id,
+            "received",
+            received_date=today(),
+            inspection_result=condition
+        )
+    
+    # Approval/rejection writes run in the background
+    order_id = return_record["order_id"]
+    _submit_write(return_id, _finalize_return, return_id, order_id, condition)
     
     # Determine if approved
-    if condition in ["good", "damaged"]:  # Accept minor damage
-        # Approve return
-        db.update_return_status(return_id, "approved")
-        
-        # Update order status
-        order_id = return_record["order_id"]
-        db.update_order_status(order_id, "refund_processing")
-        
-        # Process refund
-        refund_id = f"REF-{order_id}"
-        refund = db.get_refund(refund_id)
-        
-        if refund:
-            db.update_refund_status(
-                refund_id,
-                "completed",
-                completed_date=datetime.now().strftime("%Y-%m-%d")
-            )
-            
-            # Update return with refund info
-            db.update_return_status(return_id, "approved", refund_id=refund_id)
+    if condition in ACCEPTED_CONDITIONS:
+        refund = db.get_refund_by_order(order_id)
         
         return {
             "success": True,
-            "message": f"Return {return_id} received and approved. Refund processed.",
+            "message": f"Return {return_id} received and approved. Refund is being processed.",
             "return_id": return_id,
             "condition": condition,
             "status": "approved",
-            "refund_id": refund_id if refund else None
+            "refund_id": refund["refund_id"] if refund else None
         }
     
     else:  # damaged_beyond_acceptable
-        # Reject return
-        db.update_return_status(return_id, "rejected")
-        db.update_order_status(return_record["order_id"], "return_rejected")
-        
         return {
             "success": False,
             "message": f"Return {return_id} rejected due to condition: {condition}",
@@ -280,8 +283,71 @@ def process_return_receipt(return_id: str, condition: str) -> dict:
         }
 
 
-# Function definitions for OpenAI API
-FUNCTION_DEFINITIONS = [
+async def _finalize_return(return_id: str, order_id: str, condition: str):
+    """
+    Approve or reject a received return and update its order and refund.
+    Safe to retry: the return's own status is written last, so a failed run
+    leaves it received and process_return_receipt can submit it again.
+    """
+    db = get_db()
+    async with db.lock:
+        return_record = db.get_return(return_id)
+        if not return_record or return_record["status"] != "received":
+            return
+        
+        if condition in ACCEPTED_CONDITIONS:
+            # Update order status
+            db.update_order_status(order_id, "refund_processing")
+            
+            # Process refund (skipped if a previous attempt already completed it)
+            refund = db.get_refund_by_order(order_id)
+            refund_id = refund["refund_id"] if refund else None
+            if refund and refund["status"] != "completed":
+                db.update_refund_status(
+                    refund_id,
+                    "completed",
+                    completed_date=today()
+                )
+            
+            # Approve return with refund info
+            db.update_return_status(return_id, "approved", refund_id=refund_id)
+        
+        else:
+            # Reject return
+            db.update_order_status(order_id, "return_rejected")
+            db.update_return_status(return_id, "rejected")
+
+
+def _submit_write(key: str, write: Callable[..., Awaitable[None]], *args):
+    """Run a write in the background; a write already pending for the same key is not queued again"""
+    if key in _pending_writes:
+        return
+    task = asyncio.get_running_loop().create_task(write(*args))
+    _pending_writes[key] = task
+    
+    def done(task: asyncio.Task):
+        _pending_writes.pop(key, None)
+        if not task.cancelled() and task.exception():
+            logger.error("background_write_failed", exc_info=task.exception(), extra={"fields": {"key": key}})
+    
+    task.add_done_callback(done)
+
+
+async def _wait_for_write(key: str):
+    """Wait for the pending background write for a key, if any (its errors are logged, not raised)"""
+    task = _pending_writes.get(key)
+    if task:
+        await asyncio.wait([task])
+
+
+async def drain_background_writes():
+    """Wait for every pending background write to finish"""
+    while _pending_writes:
+        await asyncio.gather(*_pending_writes.values(), return_exceptions=True)
+
+
+# Function definitions for OpenAI API (a tuple so the shared schemas can't be appended to)
+FUNCTION_DEFINITIONS = (
     {
         "name": "check_order_status",
         "description": "Get the current status and details of a customer order. Use this to check order status, track orders, or get order information.",
@@ -296,6 +362,21 @@ FUNCTION_DEFINITIONS = [
             "required": ["order_id"]
         }
     },
+    {
+        "name": "check_order_status_batch",
+        "description": "Get the current status and details of several customer orders at once. Use this instead of check_order_status whenever you need two or more orders.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "order_ids": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "The order IDs to look up (e.g., [\"12345\", \"67890\"])"
+                }
+            },
+            "required": ["order_ids"]
+        }
+    },
     {
         "name": "check_tracking",
         "description": "Get real-time tracking information for a shipment. Use this when you have a tracking number and customer wants detailed shipping updates.",
@@ -346,4 +427,7 @@ FUNCTION_DEFINITIONS = [
             "required": ["return_id"]
         }
     }
-]
\ No newline at end of file
+)
+
+# Tool name -> implementation, for dispatching the model's tool calls
+FUNCTION_MAP = {definition["name"]: globals()[definition["name"]] for definition in FUNCTION_DEFINITIONS}
@@ -0,0 +1,53 @@
+# log_config.py
+import os
+import sys
+import logging
+import orjson
+
+# User-facing progress messages (function calls, cache hits, retries), separate
+# from structured events so --quiet can silence them independently
+ui_logger = logging.getLogger("ui")
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as one JSON object per line (structured fields go in extra={"fields": {...}})"""
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage()
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            payload.update(fields)
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return orjson.dumps(payload, default=str).decode()
+
+
+class BufferedStreamHandler(logging.StreamHandler):
+    """StreamHandler that leaves flushing to the stream's own buffering"""
+    def flush(self):
+        pass
+
+
+def configure_logging(quiet: bool = False, buffered: bool = False):
+    """
+    Send structured agent events to stderr.
+    LOG_LEVEL sets the level (default WARNING); LOG_FORMAT=json emits JSON lines.
+    UI messages go to stdout as plain text; quiet hides everything below warnings.
+    buffered skips the per-message flush of UI output (for piped/replayed runs).
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    if os.getenv("LOG_FORMAT", "").lower() == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper(), handlers=[handler])
+    
+    ui_handler = (BufferedStreamHandler if buffered else logging.StreamHandler)(sys.stdout)
+    ui_handler.setFormatter(logging.Formatter("%(message)s"))
+    ui_logger.addHandler(ui_handler)
+    ui_logger.setLevel(logging.WARNING if quiet else logging.INFO)
+    ui_logger.propagate = False
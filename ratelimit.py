@@ -0,0 +1,125 @@
+# ratelimit.py
+import time
+import random
+import asyncio
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+import tiktoken
+from log_config import ui_logger
+from openai import RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+
+T = TypeVar("T")
+
+# 429s, timeouts, dropped connections and 5xx responses are worth retrying
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+class RateLimiter:
+    """
+    Token bucket for the OpenAI request and token budgets.
+    Capacity refills continuously from the per-minute limits.
+    """
+    def __init__(self, max_requests_per_minute: Optional[float] = None, max_tokens_per_minute: Optional[float] = None):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute or 0.0
+        self.available_token_capacity = max_tokens_per_minute or 0.0
+        self._last_update = time.monotonic()
+
+    @property
+    def configured(self) -> bool:
+        """Whether both limits are known"""
+        return bool(self.max_requests_per_minute and self.max_tokens_per_minute)
+
+    def configure(self, max_requests_per_minute: float, max_tokens_per_minute: float):
+        """Set the per-minute limits and start with full buckets"""
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self._last_update = time.monotonic()
+
+    def _refill(self):
+        """Add capacity for the time elapsed since the last refill"""
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        self._last_update = now
+        self.available_request_capacity = min(
+            self.available_request_capacity + elapsed * self.max_requests_per_minute / 60,
+            self.max_requests_per_minute
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + elapsed * self.max_tokens_per_minute / 60,
+            self.max_tokens_per_minute
+        )
+
+    async def acquire(self, tokens: int):
+        """Wait until there is capacity for one request of the given size, then consume it"""
+        if not self.configured:
+            return
+        # A single request can never need more than a full bucket
+        tokens = min(tokens, self.max_tokens_per_minute)
+        while True:
+            self._refill()
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= tokens
+                return
+            # Sleep roughly until the scarcer bucket has refilled enough
+            request_wait = (1 - self.available_request_capacity) * 60 / self.max_requests_per_minute
+            token_wait = (tokens - self.available_token_capacity) * 60 / self.max_tokens_per_minute
+            await asyncio.sleep(max(request_wait, token_wait, 0.01))
+
+
+@lru_cache(maxsize=8)
+def _encoding_for(model: str):
+    """Get the tokenizer for a model (falls back to the GPT-4o encoding)"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_message_tokens(model: str, messages: List[Dict]) -> int:
+    """Estimate prompt tokens for a list of chat messages"""
+    encoding = _encoding_for(model)
+    total = 2  # reply priming
+    for message in messages:
+        total += 4  # per-message framing
+        if message.get("content"):
+            total += len(encoding.encode(message["content"]))
+        for call in message.get("tool_calls") or ():
+            total += len(encoding.encode(call["function"]["name"] + call["function"]["arguments"]))
+    return total
+
+
+async def probe_limits(client, model: str) -> Tuple[Optional[float], Optional[float]]:
+    """Read the account's request/token limits from the headers of a 1-token call"""
+    raw = await client.chat.completions.with_raw_response.create(
+        model=model,
+        messages=[{"role": "user", "content": "ping"}],
+        max_tokens=1
+    )
+    requests_limit = raw.headers.get("x-ratelimit-limit-requests")
+    tokens_limit = raw.headers.get("x-ratelimit-limit-tokens")
+    return (
+        float(requests_limit) if requests_limit else None,
+        float(tokens_limit) if tokens_limit else None
+    )
+
+
+async def with_retries(make_call: Callable[[], Awaitable[T]], max_attempts: int = 3, base_delay: float = 1.0) -> T:
+    """Run an API call, retrying retryable errors with exponential backoff and jitter"""
+    for attempt in range(max_attempts):
+        try:
+            return await make_call()
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_attempts - 1:
+                raise
+            delay = base_delay * 2 ** attempt + random.random()
+            ui_logger.warning("⏳ %s, retrying in %.1fs (attempt %d/%d)", type(e).__name__, delay, attempt + 2, max_attempts)
+            await asyncio.sleep(delay)
+
+
+# Global limiter shared by every agent using the same API key
+rate_limiter = RateLimiter()
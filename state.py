@@ -1,51 +1,73 @@
 # state.py
-from typing import Dict, Optional
+from collections import Counter
+from typing import Optional, Set, Tuple
+
+# Attempts on the same problem before the agent counts as stuck
+STUCK_THRESHOLD = 3
 
 class AgentState:
     def __init__(self):
         # Track attempts by problem category + order
-        # Format: "problem_category:order_id" -> attempt_count
-        self.attempts_by_problem: Dict[str, int] = {}
+        # Format: (problem_category, order_id) -> attempt_count
+        self.attempts_by_problem: Counter[Tuple[str, str]] = Counter()
+        
+        # Problems that have reached STUCK_THRESHOLD attempts
+        self.stuck_problems: Set[Tuple[str, str]] = set()
         
         # Current context
         self.current_order_id: Optional[str] = None
         self.current_problem_category: Optional[str] = None
+        
+        # Rendered get_summary output, re-rendered only after a change
+        self._summary_cache = ""
+        self._summary_dirty = True
     
     def record_attempt(self, problem_category: str, order_id: str):
         """Record an attempt for a specific problem"""
-        problem_key = f"{problem_category}:{order_id}"
-        self.attempts_by_problem[problem_key] = self.attempts_by_problem.get(problem_key, 0) + 1
+        problem_key = (problem_category, order_id)
+        self.attempts_by_problem[problem_key] += 1
+        if self.attempts_by_problem[problem_key] == STUCK_THRESHOLD:
+            self.stuck_problems.add(problem_key)
         
         self.current_problem_category = problem_category
         self.current_order_id = order_id
+        self._summary_dirty = True
     
     def get_attempts(self, problem_category: str, order_id: str) -> int:
         """Get number of attempts for a specific problem"""
-        problem_key = f"{problem_category}:{order_id}"
-        return self.attempts_by_problem.get(problem_key, 0)
+        return self.attempts_by_problem[(problem_category, order_id)]
     
     def is_stuck(self, problem_category: str, order_id: str) -> bool:
         """Check if stuck on this specific problem (3+ attempts)"""
-        return self.get_attempts(problem_category, order_id) >= 3
+        return (problem_category, order_id) in self.stuck_problems
     
     def reset_problem(self, problem_category: str, order_id: str):
         """Reset attempts for a specific problem (when resolved)"""
-        problem_key = f"{problem_category}:{order_id}"
-        if problem_key in self.attempts_by_problem:
-            del self.attempts_by_problem[problem_key]
+        problem_key = (problem_category, order_id)
+        self.attempts_by_problem.pop(problem_key, None)
+        self.stuck_problems.discard(problem_key)
+        self._summary_dirty = True
     
     def reset_all(self):
         """Clear all attempt tracking"""
-        self.attempts_by_problem = {}
+        self.attempts_by_problem = Counter()
+        self.stuck_problems = set()
         self.current_order_id = None
         self.current_problem_category = None
+        self._summary_dirty = True
     
     def get_summary(self) -> str:
-        """Get a summary of current state"""
-        return f"""
+        """Get a summary of current state (cached until the state changes)"""
+        if self._summary_dirty:
+            attempts = ", ".join(
+                f"'{category}:{order_id}': {count}" for (category, order_id), count in self.attempts_by_problem.items()
+            )
+            self._summary_cache = f"""
 Agent State Summary:
 - Problems tracked: {len(self.attempts_by_problem)}
 - Current order: {self.current_order_id or 'None'}
 - Current problem: {self.current_problem_category or 'None'}
-- Attempts by problem: {self.attempts_by_problem}
-"""
\ No newline at end of file
+- Attempts by problem: {{{attempts}}}
+"""
+            self._summary_dirty = False
+        return self._summary_cache